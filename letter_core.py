@@ -0,0 +1,646 @@
+"""Core logic for the valorizzazione letter generator.
+
+Configuration, movement aggregation and DOCX assembly live here so the
+Streamlit front end (streamlit_app.py) only handles widgets and caching.
+"""
+
+# ---- Imports ------------------------------------------------------------
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+from functools import lru_cache
+from io import BytesIO
+import re
+import numpy as np
+import pandas as pd
+from docx import Document
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.shared import Inches, Pt
+from typing import List
+
+# ╔══════════════════════════════════════════════════════════════════════╗
+# ║  HARD‑CODED CONFIGURATION                                            ║
+# ╚══════════════════════════════════════════════════════════════════════╝
+
+ITEM_CONFIG = {
+    # ────────────────  Table T1  ────────────────
+    "Acquisition cost deduction from regular premium": {
+        "label": "Costi di emissione e gestione",
+        "table": "T1",
+        "pos": 1,
+    },
+    "Contract fee deduction from regular premium": {
+        "label": "Costi di emissione e gestione",
+        "table": "T1",
+        "pos": 1,                 # same position; rows will merge
+    },
+    "Acquisition cost deduction from single premium": {
+        "label": "Costi di emissione e gestione",
+        "table": "T1",
+        "pos": 1,
+    },
+    "Contract fee deduction from single premium": {
+        "label": "Costi di emissione e gestione",
+        "table": "T1",
+        "pos": 1,
+    },
+
+    "Administrative deduction": {
+        "label": "Costi di caricamento",
+        "table": "T1",
+        "pos": 2,
+    },
+
+    "Investment deduction": {
+        "label": "Costi di investimento",
+        "table": "T1",
+        "pos": 3,
+    },
+    "Investment deduction from Regular Premium Balance": {
+        "label": "Costi di investimento",
+        "table": "T1",
+        "pos": 3,
+    },
+    "Investment deduction from Single PremiumBalance": {
+        "label": "Costi di investimento",
+        "table": "T1",
+        "pos": 3,
+    },
+
+    "Investment return from insurance funds": {
+        "label": "Capitalizzazione",
+        "table": "T1",
+        "pos": 4,
+    },
+
+    "Investment return from insurance funds of Regular premium": {
+        "label": "Capitalizzazione",
+        "table": "T1",
+        "pos": 4,
+    },
+
+    "Investment return from insurance funds of Single premium": {
+        "label": "Capitalizzazione",
+        "table": "T1",
+        "pos": 4,
+    },
+
+    "Paid Premium": {
+        "label": "Pagamenti dei Premi identificati",
+        "table": "T1",
+        "pos": 5,
+    },
+    
+    "Paid Single Premium": {
+        "label": "Pagamenti dei Premi identificati",
+        "table": "T1",
+        "pos": 5,
+    },
+
+    "Paid Extra Premium": {
+        "label": "Pagamenti dei Premi identificati",
+        "table": "T1",
+        "pos": 5,
+    },
+    
+    "Returned Premium": {
+        "label": "Pagamenti dei Premi identificati",
+        "table": "T1",
+        "pos": 5,
+    },
+
+    "Risk deduction - Death": {
+        "label": "Trattenuta copertura rischio morte",
+        "table": "T1",
+        "pos": 6,
+    },
+  
+    "Risk deduction - accident insurance deduction": {
+        "label": "Trattenuta copertura rischio infortunio",
+        "table": "T1",
+        "pos": 7,
+    },
+  
+    "Risk deduction - Illnesses and operations": {
+        "label": "Trattenuta copertura rischio malattia, interventi chirurgici e assistenza",
+        "table": "T1",
+        "pos": 8,
+    },
+  
+   "Risk deduction - Waiver of premium": {
+        "label": "Esonero Pagamento Premi ITP",
+        "table": "T1",
+        "pos": 9,      # appears after ordered rows
+    },
+  
+    "Partial surrender": {
+         "label": "Riscatto (parziale)",
+         "table": "T1",
+         "pos": 10,
+    },
+  
+    "Partial Surrender Calculated value": {
+         "label": "Riscatto (parziale)",
+         "table": "T1",
+         "pos": 10,
+    },
+
+    "Stamp Duty Fee": {
+         "label": "Imposta di bollo",
+         "table": "T1",
+         "pos": 11,
+    },
+
+    # ────────────────  Table T2  ────────────────
+    "Investment return of Novis Loyalty Bonus": {
+        "label": "Rendimento Bonus Fedeltà NOVIS",
+        "table": "T2",
+        "pos": 1,
+    },
+    "Investment deduction of Novis Loyalty Bonus": {
+        "label": "Costi di investimento - Bonus Fedeltà NOVIS",
+        "table": "T2",
+        "pos": 1,
+    },
+    # If the raw file already contains the Italian string use it directly:
+    "NOVIS Loyalty Bonus": {
+        "label": "Bonus Fedeltà NOVIS",
+        "table": "T2",
+        "pos": 2,
+    },
+  
+    # ────────────────  Table T3 (Special Bonus)  ────────────────
+    "NOVIS Special Bonus": {
+        "label": "NOVIS Special Bonus",
+        "table": "T3",
+        "pos": 1,        # only row in its table
+    },
+   }
+ 
+LABEL_POS = {cfg["label"]: cfg.get("pos", 999) for cfg in ITEM_CONFIG.values()}
+
+# flat lookup tables so aggregation can use vectorized Series.map
+_NAME2LABEL = {k: v["label"] for k, v in ITEM_CONFIG.items()}
+# Series form takes pandas' hash-table map fast path (no per-row dict probe)
+_NAME2LABEL_SERIES = pd.Series(_NAME2LABEL)
+_NAME2TABLE = {k: v["table"] for k, v in ITEM_CONFIG.items()}
+# each label lives in exactly one table; unknown labels land in T1
+_LABEL2TABLE = {v["label"]: v["table"] for v in ITEM_CONFIG.values()}
+
+POSITIVE_LABELS = {
+    "Pagamenti dei Premi identificati",
+    "Rendimento Bonus Fedeltà NOVIS",
+    "Bonus Fedeltà NOVIS",
+    "NOVIS Special Bonus",
+}
+# labels whose raw sign is kept as-is ('Capitalizzazione' can be ±)
+_KEEP_SIGN_LABELS = frozenset(POSITIVE_LABELS | {"Capitalizzazione"})
+
+TABLE_CONFIG = {
+    # title empty → no "Item / Importo" header row (as in template)
+    "T1": {"title": "", "include_total": True, "total_label": "Somma totale (escluso Bonus Fedeltà NOVIS e Special Bonus)"},
+    "T2": {"title": "", "include_total": True, "total_label": "Bonus Fedeltà NOVIS con rendimento"},
+    "T3": {"title": "", "include_total": False},
+}
+
+# table ids in config order as integer codes, for array-based sorting
+_TABLE_IDS = tuple(TABLE_CONFIG)
+_TABLE_IDX = {tid: i for i, tid in enumerate(_TABLE_IDS)}
+
+LETTER_SUBJECT_TPL = (
+    "Dettaglio costi per il valore della Sua posizione assicurativa polizza n. "
+    "{contract_number} al {calc_date_str} con codice fiscale {cf}."
+)
+
+OUTRO_PARAGRAPH = (
+    "Qualora necessitasse di ulteriori informazioni in merito, La invitiamo "
+    "gentilmente a riferirsi alla Tabella Costi contenuta nelle Condizioni di Assicurazione.\n\n"
+    "Rimaniamo a disposizione per qualsiasi chiarimento e, ringraziando per la "
+    "cortese attenzione, Le porgiamo i nostri più cordiali saluti."
+)
+GOODBYE_LINE = ""
+SIGNATURE_BLOCK = (
+    "Il team NOVIS"
+)
+# ── constants (add near the other CONFIG blocks) ──────────────────────
+SALUTATION_ADDR = {
+    "male": "Egr. Sig.",
+    "female": "Gent.ma Sig.ra",
+    "company": "Spett.le",
+}
+SALUTATION_GREET = {
+    "male": "Egregio Signor",
+    "female": "Gentilissima Signora",
+    "company": "Spettabile",
+}
+
+COLUMN_ALIASES = {
+    "EntryDate": "Item date",
+    "ValueDate": "Item date",
+    "EntryType": "Item name",
+    "Amount": "Item value",
+}
+EXPECTED_COLS = {"Item date", "Item name", "Item value"}
+_EXPECTED = tuple(EXPECTED_COLS)   # tuple for the cheap all(...) membership scan
+_ALIAS_ITEMS = tuple(COLUMN_ALIASES.items())
+
+# -------------------------------------------------------------------------
+#  HELPERS
+# -------------------------------------------------------------------------
+
+# hand-rolled it_IT euro formatting: '.' thousands, ',' decimals, NBSP + €
+# (byte-identical to Babel's output for this fixed locale/currency, minus
+# the per-call CLDR pattern walk)
+_SWAP_SEPARATORS = str.maketrans({",": ".", ".": ","})
+
+@lru_cache(maxsize=4096)
+def _fmt_cents(cents: int) -> str:
+    sign = "-" if cents < 0 else ""
+    body = f"{abs(cents) / 100:,.2f}".translate(_SWAP_SEPARATORS)
+    return f"{sign}{body} €"
+
+def _fmt(amount: float) -> str:
+    # key the cache on whole cents: repeated amounts format once
+    return _fmt_cents(int(round(amount * 100)))
+
+def last_day_prev_month(d: date) -> date:
+    """Return the last calendar day of the month preceding *d*."""
+    return d.replace(day=1) - timedelta(days=1)
+
+# lowercase only: last_name lowercases before the lookup anyway
+_SURNAME_PREFIXES = frozenset(
+    {"di", "de", "del", "della", "d'", "da", "van", "von", "la", "le"}
+)
+
+@lru_cache(maxsize=256)
+def last_name(name: str) -> str:
+    """Return the surname; keep prefixes like 'Di', 'De', 'Del', etc."""
+    tokens = name.split()
+    if len(tokens) >= 2 and tokens[-2].lower() in _SURNAME_PREFIXES:
+        return " ".join(tokens[-2:])           # 'Di Salvatore'
+    return tokens[-1]                          # default: last token only
+
+@lru_cache(maxsize=256)
+def make_intro(recipient_type: str, client_name: str, calc_date: str) -> str:
+    """
+    Builds the greeting + first paragraph in one shot, e.g.
+    'Egregio Signor Rossi,\nsiamo con la presente … al 30/06/2025.'
+    """
+    if recipient_type == "company":
+        greet_name = client_name
+    else:
+        greet_name = last_name(client_name)           # keeps 'Di Salvatore'
+
+    greeting = f"{SALUTATION_GREET[recipient_type]} {greet_name},"
+    body = (
+        "siamo con la presente a trasmetterLe di seguito la tabella riportante il "
+        "dettaglio dei costi applicati ai fini di calcolo del valore della Sua "
+        f"posizione assicurativa al {calc_date}."
+    )
+    return f"{greeting}\n{body}"
+
+
+def standardise_columns(df: pd.DataFrame) -> pd.DataFrame:
+    cols = df.columns
+    if all(c in cols for c in _EXPECTED):   # fast path: no Index materialisation
+        return df
+    cols_set = set(cols)
+    # only rename aliases that exist and whose canonical name is still free
+    renamed = {o: c for o, c in _ALIAS_ITEMS if o in cols_set and c not in cols_set}
+    if renamed:
+        df = df.rename(columns=renamed)
+        cols_set.update(renamed.values())
+    if not all(c in cols_set for c in _EXPECTED):
+        raise ValueError("Il file non contiene le colonne richieste.")
+    return df
+
+
+def _group_sum(codes: np.ndarray, signed: np.ndarray, n_labels: int) -> np.ndarray:
+    """Accumulate signed amounts per label code in one C-level pass."""
+    return np.bincount(codes, weights=signed, minlength=n_labels)
+
+
+def aggregate_tables(
+    df: pd.DataFrame,
+) -> tuple[dict[str, pd.DataFrame], dict[str, float], list[str]]:
+    values = pd.to_numeric(df["Item value"], errors="coerce").to_numpy(dtype=np.float64)
+    keep = ~np.isnan(values)
+    values = values[keep]
+    names = pd.Series(df["Item name"].to_numpy()[keep])
+
+    mapped = names.map(_NAME2LABEL_SERIES)
+    unmapped_mask = mapped.isna().to_numpy()
+    # unknown item names pass through under their raw label; report them so
+    # the operator can spot a movement type missing from ITEM_CONFIG
+    unmapped = sorted(set(names.to_numpy()[unmapped_mask])) if unmapped_mask.any() else []
+    labels = mapped.fillna(names)
+    # invert sign for every label NOT in POSITIVE_LABELS (except we keep actual sign
+    # for 'Capitalizzazione')
+    pos_mask = labels.isin(_KEEP_SIGN_LABELS).to_numpy()
+    signed = np.where(pos_mask, values, -values)
+
+    # integer-encode the labels, then sum in a single accumulation pass
+    codes, uniq_labels = pd.factorize(labels.to_numpy())
+    totals = _group_sum(codes, signed, len(uniq_labels))
+
+    nonzero = totals != 0                        # ← hide rows that net to €0
+    uniq_labels = np.asarray(uniq_labels)[nonzero]
+    totals = totals[nonzero]
+    if totals.size == 0:
+        return {}, {}, unmapped
+
+    # integer sort keys: one lexsort replaces the pandas multi-column sort
+    n = totals.size
+    table_codes = np.fromiter(
+        (_TABLE_IDX.get(_LABEL2TABLE.get(lbl, "T1"), 0) for lbl in uniq_labels),
+        np.int32, n,
+    )
+    pos = np.fromiter((LABEL_POS.get(lbl, 999) for lbl in uniq_labels), np.int32, n)
+    label_rank = np.argsort(np.argsort(uniq_labels))    # alphabetical tie-break
+    order = np.lexsort((label_rank, pos, table_codes))
+
+    uniq_labels = uniq_labels[order]
+    totals = totals[order]
+    table_codes = table_codes[order]
+
+    # slice on table boundaries — no second groupby
+    starts = np.r_[0, np.flatnonzero(np.diff(table_codes)) + 1]
+    ends = np.r_[starts[1:], n]
+    # carry the formatted amounts along so preview and DOCX share one pass,
+    # and the subtotals so neither caller re-sums the amounts on rerun
+    tables: dict[str, pd.DataFrame] = {}
+    subtotals: dict[str, float] = {}
+    for a, b in zip(starts, ends):
+        tid = _TABLE_IDS[table_codes[a]]
+        tables[tid] = pd.DataFrame(
+            {
+                "Label": uniq_labels[a:b],
+                "Amount": totals[a:b],
+                "Importo": [_fmt(v) for v in totals[a:b]],
+            }
+        )
+        subtotals[tid] = float(totals[a:b].sum())
+    return tables, subtotals, unmapped
+
+def doc_to_buffer(doc: Document) -> BytesIO:
+    """Serialize once and hand back the buffer — getvalue() would copy it."""
+    buf = BytesIO()
+    doc.save(buf)
+    buf.seek(0)
+    return buf
+
+def _style_or_none(doc: Document, style_name: str):
+    """Resolve a Word style object once; None if the template lacks it."""
+    try:
+        return doc.styles[style_name]
+    except KeyError:
+        return None
+
+from xml.sax.saxutils import escape as _xml_escape
+
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+
+
+def _cell_xml(text: str, bold: bool = False, right: bool = False) -> str:
+    """One <w:tc> holding a single run; styling is inlined, no wrappers."""
+    rpr = "<w:rPr><w:b/></w:rPr>" if bold else ""
+    ppr = '<w:pPr><w:jc w:val="right"/></w:pPr>' if right else ""
+    return (
+        f"<w:tc><w:p>{ppr}<w:r>{rpr}"
+        f'<w:t xml:space="preserve">{_xml_escape(text)}</w:t>'
+        f"</w:r></w:p></w:tc>"
+    )
+
+
+# 0.5-pt black borders on all six edges, rendered once at import
+_TBL_BORDERS_XML = "<w:tblBorders>" + "".join(
+    f'<w:{edge} w:val="single" w:sz="4" w:color="000000"/>'
+    for edge in ("top", "left", "bottom", "right", "insideH", "insideV")
+) + "</w:tblBorders>"
+
+_TBL_PREAMBLE = (
+    f"<w:tbl {nsdecls('w')}>"
+    f'<w:tblPr><w:tblW w:w="0" w:type="auto"/>{_TBL_BORDERS_XML}</w:tblPr>'
+    f"<w:tblGrid><w:gridCol/><w:gridCol/></w:tblGrid>"
+)
+
+
+def _build_table_xml(
+    rows: List[tuple],
+    bold_rows: set,
+    total: tuple | None,
+    header: bool = False,
+) -> str:
+    """
+    Compose a whole two-column <w:tbl> (0.5-pt borders inlined) as one XML
+    string, avoiding per-row python-docx object construction.
+    """
+    parts = [_TBL_PREAMBLE]
+    if header:
+        parts.append(
+            f"<w:tr>{_cell_xml('Item')}{_cell_xml('Importo', right=True)}</w:tr>"
+        )
+    for i, (label, fmt) in enumerate(rows):
+        bold = i in bold_rows
+        parts.append(
+            f"<w:tr>{_cell_xml(label, bold=bold)}"
+            f"{_cell_xml(fmt, bold=bold, right=True)}</w:tr>"
+        )
+    if total is not None:
+        label, fmt = total
+        parts.append(
+            f"<w:tr>{_cell_xml(label, bold=True)}"
+            f"{_cell_xml(fmt, bold=True, right=True)}</w:tr>"
+        )
+    parts.append("</w:tbl>")
+    return "".join(parts)
+
+
+def _append_table_xml(doc: Document, xml: str):
+    """Attach a prebuilt table element to the document body (before sectPr)."""
+    doc.element.body.insert_element_before(parse_xml(xml), "w:sectPr")
+
+# one alternation, compiled once: a single scan replaces four re.search passes
+_CLIP_RE = re.compile(
+    r"Contract number:\s*(?P<contract>.+)"
+    r"|Policyholder:\s*(?P<name>.+)"
+    r"|Permanent residence:\s*(?P<addr>.+)"
+    r"|Personal number:\s*(?P<cf>.+)",
+    re.I,
+)
+
+def parse_clipboard(blob: str) -> dict:
+    """
+    Extract contract, name, address, fiscal code from the pasted block.
+    Returns {"contract": …, "name": …, "addr": …, "cf": …}
+    Missing fields come back empty.
+    """
+    out = {"contract": "", "name": "", "addr": "", "cf": ""}
+    for m in _CLIP_RE.finditer(blob):
+        out[m.lastgroup] = m.group(m.lastgroup).strip()
+    return out
+
+@lru_cache(maxsize=256)
+def split_addr(addr: str) -> tuple[str, ...]:
+    """
+    Turn  'Street 8, 23849 Rogeno, Italy'
+    into ('Street 8', '23849 Rogeno', 'Italy').
+    Returns a tuple so the result is hashable and cacheable.
+    """
+    return tuple(p.strip() for p in addr.split(",") if p.strip())
+
+
+# -------------------------------------------------------------------------
+#  DOCX BUILDER
+# -------------------------------------------------------------------------
+
+TEMPLATE_PATH = "Novis_hl_papier_IT_motyl_12072023_prev.docx"
+
+@lru_cache(maxsize=1)
+def load_template_bytes() -> bytes:
+    """Read the letter template once per process; build_doc re-parses from RAM.
+
+    The static tweaks we make to every letter (Normal at 11pt) are baked into
+    the cached bytes here, so per-letter builds skip the style mutation.
+    """
+    doc = Document(TEMPLATE_PATH)
+    doc.styles["Normal"].font.size = Pt(11)
+    buf = BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+def build_doc(
+    client_name: str,
+    client_addr: str,
+    cf: str,
+    contract: str,
+    calc_date: str,
+    tables: dict[str, pd.DataFrame],
+    recipient_type: str = "male",
+    city: str = "Bratislava",
+    subtotals: dict[str, float] | None = None,
+) -> Document:
+    
+    doc = Document(BytesIO(load_template_bytes()))
+
+    # resolve heading styles once instead of per-paragraph name lookups
+    h2_style = _style_or_none(doc, "Heading 2")
+    h3_style = _style_or_none(doc, "Heading 3")
+
+    # address block — one paragraph with line breaks instead of one per line
+    prefix_short = SALUTATION_ADDR[recipient_type]
+    p = doc.add_paragraph()
+    p.paragraph_format.left_indent = Inches(4)
+    run = p.add_run(f"{prefix_short} {client_name}")
+    for line in split_addr(client_addr):
+        run.add_break()
+        run = p.add_run(line)
+
+    today_str = date.today().strftime("%d/%m/%Y")
+    r = doc.add_paragraph(f"{city}, {today_str}")
+    doc.add_paragraph("")   # blank
+    
+    # 2-line replacement for the subject block
+    p = doc.add_paragraph()
+    if h2_style is not None:
+        p.style = h2_style
+    p.add_run("Dettaglio costi per il valore della Sua posizione assicurativa polizza n. ").bold = True
+    p.add_run(contract).bold = True              # policy number
+    p.add_run(f" al {calc_date} con codice fiscale ").bold = True
+    p.add_run(cf).bold = True                    # codice fiscale
+    
+    doc.add_paragraph("")  # blank line after subject
+    
+    intro_text = make_intro(recipient_type, client_name, calc_date)
+    para = doc.add_paragraph(intro_text)
+    para.alignment = WD_ALIGN_PARAGRAPH.LEFT      # greeting left-aligned
+    doc.add_paragraph("")  # blank line after intro
+
+    grand_total = (
+        sum(subtotals.values())
+        if subtotals is not None
+        else float(sum(t["Amount"].sum() for t in tables.values()))
+    )
+
+    # aggregate_tables emits the dict in TABLE_CONFIG order already
+    for tid, df_tbl in tables.items():
+        cfg = TABLE_CONFIG[tid]
+
+        if cfg["title"]:
+            title_p = doc.add_paragraph(cfg["title"])
+            if h3_style is not None:
+                title_p.style = h3_style
+      
+        # iterate plain arrays: iterrows would build a Series per row
+        labels = df_tbl["Label"].to_numpy()
+        fmts = df_tbl["Importo"].to_numpy()
+
+        # bold the Special Bonus row
+        bold_rows = {i for i, lbl in enumerate(labels) if lbl == "NOVIS Special Bonus"}
+
+        subtotal = (
+            subtotals[tid] if subtotals is not None else float(df_tbl["Amount"].sum())
+        )
+        total = (
+            (cfg.get("total_label", "Totale"), _fmt(subtotal))
+            if cfg.get("include_total")
+            else None
+        )
+        _append_table_xml(
+            doc,
+            _build_table_xml(
+                list(zip(labels, fmts)),
+                bold_rows,
+                total,
+                header=bool(cfg["title"]),
+            ),
+        )
+
+        doc.add_paragraph("")
+
+    # grand-total as its own table (single bold row)
+    _append_table_xml(
+        doc,
+        _build_table_xml(
+            [],
+            set(),
+            (
+                "Valore della Sua posizione assicurativa (incluso Bonus Fedeltà NOVIS e NOVIS Special Bonus)",
+                _fmt(grand_total),
+            ),
+        ),
+    )
+
+    doc.add_paragraph("")           # spacer
+    doc.add_paragraph(OUTRO_PARAGRAPH)
+    doc.add_paragraph("")
+    doc.add_paragraph(SIGNATURE_BLOCK)
+    doc.add_paragraph("")                 # empty line after "Il team NOVIS"
+    doc.add_paragraph(
+    "NOVIS Insurance Company,\n"
+    "NOVIS Versicherungsgesellschaft,\n"
+    "NOVIS Compagnia di Assicurazioni,\n"
+    "NOVIS Poisťovňa a.s."
+    )
+    return doc
+
+
+def _build_one_doc_bytes(job: dict) -> bytes:
+    """Build a single letter from build_doc keyword arguments.
+
+    Top-level (not a closure) so ProcessPoolExecutor can pickle it.
+    """
+    return doc_to_buffer(build_doc(**job)).getvalue()
+
+
+def build_letters_batch(jobs: List[dict]) -> List[bytes]:
+    """Build many letters in parallel, one per entry in *jobs*.
+
+    Each job is a dict of build_doc keyword arguments. python-docx cannot
+    share a Document between builds, so worker processes each own a full
+    Document and the batch scales with core count.
+    """
+    if len(jobs) <= 1:
+        return [_build_one_doc_bytes(j) for j in jobs]
+    with ProcessPoolExecutor() as ex:
+        return list(ex.map(_build_one_doc_bytes, jobs, chunksize=4))